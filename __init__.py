@@ -1,10 +1,33 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Any, Dict, Optional
-from random import shuffle
+from importlib.util import find_spec
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
 import json
+import re
+import numpy as np
 import pandas as pd
 
+# The Rust-based calamine engine (pandas >= 2.2 with python-calamine installed) reads excel files much faster than the
+# default openpyxl engine. None lets pandas pick its default engine.
+if find_spec('python_calamine') is not None and tuple(int(x) for x in pd.__version__.split('.')[:2]) >= (2, 2):
+    _EXCEL_ENGINE = 'calamine'
+else:
+    _EXCEL_ENGINE = None
+
+# orjson parses JSON much faster than the standard library. It is only used for reading metadata: its output is
+# formatted differently from json.dumps, and serialized sequences should not depend on which packages are installed.
+try:
+    import orjson
+
+    def _json_loads(s: str) -> Any:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than json.dumps output, e.g. it rejects NaN and integers larger than 64 bits
+            return json.loads(s)
+except ImportError:
+    _json_loads = json.loads
+
 class MedicalCodingSequencer(ABC):
     """ Abstract Base Class for medical coding sequencers """
     def __init__(self):
@@ -19,33 +42,53 @@ class MedicalCodingSequencer(ABC):
         pass
 
 
+# String representation of a TemporalRecord: (timestamp, code)
+_REC_RE = re.compile(r'\((\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}\.\d{6}), (.*?)\)')
+
+
+def _naive(timestamp: datetime) -> datetime:
+    """ Drops the timezone of a timestamp, keeping its wall-clock time """
+    if getattr(timestamp, 'tzinfo', None) is not None:
+        return timestamp.replace(tzinfo=None)
+    return timestamp
+
+
 class TemporalRecord:
     """ A single instance of a timestamped record """
+    __slots__ = ('timestamp', 'code')
+
     def __init__(self, timestamp: datetime, code: Any):
         self.timestamp = timestamp
         self.code = code
 
     def serialize(self):
         """ String representation of the format (timestamp, code) """
-        return f'({self.timestamp.strftime("%Y-%m-%d_%H:%M:%S.%f")}, {self.code})'
+        t = self.timestamp
+        return f'({t.year:04d}-{t.month:02d}-{t.day:02d}_{t.hour:02d}:{t.minute:02d}:{t.second:02d}.' \
+               f'{t.microsecond:06d}, {self.code})'
 
     @staticmethod
     def read(input_str):
         """ Reads the string representation back into a TemporalRecord object """
-        input_list = input_str[1:-1].split(', ')
-        timestamp = datetime.strptime(input_list[0], '%Y-%m-%d_%H:%M:%S.%f')
-        code = input_list[1]
+        m = _REC_RE.fullmatch(input_str)
+        if m is None:
+            raise ValueError()
+        # Timestamp has the fixed-width format %Y-%m-%d_%H:%M:%S.%f
+        s, code = m.groups()
+        timestamp = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                             int(s[20:26]))
         return TemporalRecord(timestamp, code)
 
 
 class TemporalSequencer(MedicalCodingSequencer):
     """ Converts a list of TemporalRecords (not necessarily ordered) into an ordered Temporal Sequence """
+    # Maps each shuffle level to its length in microseconds, the resolution timestamps are stored at
     _shuffle_dict = {
-        'd': '%Y-%m-%d',
-        'H': '%Y-%m-%d_%H',
-        'M': '%Y-%m-%d_%H:%M',
-        'S': '%Y-%m-%d_%H:%M:%S',
-        'f': '%Y-%m-%d_%H:%M:%S.%f',
+        'd': 86400 * 1000000,
+        'H': 3600 * 1000000,
+        'M': 60 * 1000000,
+        'S': 1000000,
+        'f': 1,
     }
 
     def __init__(self, metadata: Dict = None, sep: str = '\t'):
@@ -57,30 +100,146 @@ class TemporalSequencer(MedicalCodingSequencer):
                   and metadata may include person_id. Must be JSON serializable.
         sep: str - Separator character. Default: tab
         """
-        self.data = list()
+        # Timestamps and codes are stored as parallel arrays. Newly added records are buffered in lists, and arrays
+        # added in bulk in a list of chunks, until they are needed, so that adding records does not reallocate the
+        # arrays each time. Timestamps are stored as naive datetime64[us]: the timezone of timezone-aware timestamps
+        # is dropped, keeping their wall-clock time.
+        self._timestamps = np.empty(0, dtype='datetime64[us]')
+        self._codes = np.empty(0, dtype=object)
+        self._new_timestamps = list()
+        self._new_codes = list()
+        self._new_chunks = list()
 
         if metadata is None:
             self.metadata = dict()
+        elif isinstance(metadata, dict):
+            self.metadata = metadata
         else:
-            if type(metadata) is dict:
-                self.metadata = metadata
-            else:
-                raise ValueError()
+            raise ValueError()
 
         self.sep = sep
         self._shuffle_level = None
-        self._sequenced = False
+        self._reverse = False
+        # An empty sequencer is trivially sequenced. _max_ts is the latest timestamp while the data is in ascending
+        # order, so that records that are not earlier can be appended without sequencing again.
+        self._sequenced = True
+        self._max_ts = None
         super().__init__()
 
-    def add_data(self, timestamp: datetime, code: Any):
-        """ Adds timestamp and code to the data to be sequenced """
-        self.data.append(TemporalRecord(timestamp, code))
+    def __iter__(self) -> Iterator[Tuple[datetime, Any]]:
+        """ Iterates over (timestamp, code) tuples, in sequenced order if the data has been sequenced. Cheaper than
+        the data property since no TemporalRecords are created """
+        self._consolidate()
+        return zip(self._timestamps.astype(object), self._codes)
+
+    @property
+    def data(self) -> Tuple[TemporalRecord, ...]:
+        """ Read-only tuple of TemporalRecords, in sequenced order if the data has been sequenced. Use add_data or
+        assign a new list of TemporalRecords to change the data """
+        return tuple(TemporalRecord(t, c) for t, c in self)
+
+    @data.setter
+    def data(self, records: Iterable[TemporalRecord]):
+        """ Replaces the data with the given TemporalRecords. The data needs to be sequenced again """
+        timestamps = list()
+        codes = list()
+        for r in records:
+            # Missing timestamps cannot be sequenced
+            if pd.isna(r.timestamp):
+                raise ValueError()
+            timestamps.append(_naive(r.timestamp))
+            codes.append(r.code)
+        self._timestamps = np.empty(0, dtype='datetime64[us]')
+        self._codes = np.empty(0, dtype=object)
+        self._new_timestamps = timestamps
+        self._new_codes = codes
+        self._new_chunks = list()
         self._sequenced = False
+        self._max_ts = None
+
+    def _buffer_new(self):
+        """ Moves records buffered in lists into the chunks of arrays waiting to be consolidated """
+        if self._new_timestamps:
+            timestamps = np.array(self._new_timestamps, dtype='datetime64[us]')
+            codes = np.fromiter(self._new_codes, dtype=object, count=len(self._new_codes))
+            self._new_chunks.append((timestamps, codes))
+            self._new_timestamps = list()
+            self._new_codes = list()
+
+    def _consolidate(self):
+        """ Moves buffered records into the timestamp and code arrays """
+        self._buffer_new()
+        if self._new_chunks:
+            self._timestamps = np.concatenate([self._timestamps] + [t for t, _ in self._new_chunks])
+            self._codes = np.concatenate([self._codes] + [c for _, c in self._new_chunks])
+            self._new_chunks = list()
+
+    def _extends_sequence(self, timestamp: np.datetime64) -> bool:
+        """ Checks whether records starting at timestamp can be appended while keeping the data sequenced """
+        if len(self._timestamps) == 0 and not self._new_timestamps and not self._new_chunks:
+            return True
+        return self._max_ts is not None and timestamp >= self._max_ts
+
+    def add_data(self, timestamp: datetime, code: Any):
+        """ Adds timestamp and code to the data to be sequenced. The timezone of timezone-aware timestamps is dropped,
+        keeping their wall-clock time """
+        # Missing timestamps cannot be sequenced
+        if pd.isna(timestamp):
+            raise ValueError()
+        timestamp = _naive(timestamp)
+        if self._sequenced and self._shuffle_level is None and not self._reverse:
+            # Appending records in chronological order is common, and does not require sequencing again
+            timestamp64 = np.datetime64(timestamp, 'us')
+            if self._extends_sequence(timestamp64):
+                self._max_ts = timestamp64
+            else:
+                self._sequenced = False
+        else:
+            self._sequenced = False
+        self._new_timestamps.append(timestamp)
+        self._new_codes.append(code)
+
+    def add_bulk(self, timestamps: Iterable[datetime], codes: Iterable[Any], is_sorted: bool = False):
+        """ Adds many timestamps and codes to the data to be sequenced at once
+
+        Params
+        ======
+        timestamps: iterable of datetime - Timestamps of the records. NumPy datetime64 arrays and pandas Series are
+                    added without converting each timestamp. The timezone of timezone-aware timestamps is dropped.
+                    Missing timestamps are not allowed
+        codes: iterable - Codes of the records. Must be the same length as timestamps
+        is_sorted: bool - True if timestamps are already in ascending order, e.g., rows from a query with ORDER BY. If
+                   they also do not precede any records already added, the data does not need to be sorted again.
+                   Default: False
+        """
+        if isinstance(timestamps, pd.Series) and isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+            timestamps = timestamps.dt.tz_localize(None)
+        elif isinstance(timestamps, pd.DatetimeIndex) and timestamps.tz is not None:
+            timestamps = timestamps.tz_localize(None)
+        elif not isinstance(timestamps, (np.ndarray, pd.Series, pd.Index)) or timestamps.dtype == object:
+            timestamps = [_naive(t) for t in timestamps]
+        timestamps = np.asarray(timestamps, dtype='datetime64[us]')
+        if isinstance(codes, (np.ndarray, pd.Series, pd.Index)):
+            codes = np.asarray(codes, dtype=object)
+        else:
+            codes = np.fromiter(codes, dtype=object)
+        if len(timestamps) != len(codes) or np.isnat(timestamps).any():
+            raise ValueError()
+        if len(timestamps) == 0:
+            return
+
+        if is_sorted and self._sequenced and self._shuffle_level is None and not self._reverse \
+                and self._extends_sequence(timestamps[0]):
+            self._max_ts = timestamps[-1]
+        else:
+            self._sequenced = False
+        # Buffered records were added first, so they must stay ahead of the new chunk
+        self._buffer_new()
+        self._new_chunks.append((timestamps, codes))
 
     def add_temporal_record(self, ts: TemporalRecord):
         """ Adds TemporalRecord to the data to be sequenced """
-        self.data.append(ts)
-        self._sequenced = False
+        self.add_data(ts.timestamp, ts.code)
 
     def sequence(self, shuffle_level: str = None, reverse=False):
         """ Sequences the data
@@ -101,32 +260,29 @@ class TemporalSequencer(MedicalCodingSequencer):
         if shuffle_level is not None and (type(shuffle_level) is not str or shuffle_level not in TemporalSequencer._shuffle_dict.keys()):
             raise ValueError()
         self._shuffle_level = shuffle_level
+        self._reverse = reverse
+
+        self._consolidate()
+        # Sort on the timestamps as int64 microseconds since the epoch. Sorting negated keys gives a stable descending
+        # order for reverse.
+        times = self._timestamps.view('int64')
 
-        # First, sort strictly by timestamp
-        self.data.sort(key=lambda x: x.timestamp, reverse=reverse)
-
-        if shuffle_level is not None:
-            # Shuffle records that occur at the same time level
-            fmt = TemporalSequencer._shuffle_dict[shuffle_level]
-            new_seq = list()
-            current_datetime = None
-            current_group = list()
-            for r in self.data:
-                # Convert the datetime to a string of a certain precision as a crude way of ignoring lower precision
-
-                new_datetime = r.timestamp.strftime(fmt)
-                if new_datetime != current_datetime:
-                    # Shuffle the current group of records and add them to the new sequence
-                    shuffle(current_group)
-                    new_seq.extend(current_group)
-
-                    # Start keeping track of the new group of records
-                    current_datetime = new_datetime
-                    current_group = list()
-                current_group.append(r)
-            self.data = new_seq
+        if shuffle_level is None:
+            # Sort strictly by timestamp
+            order = np.argsort(-times if reverse else times, kind='stable')
+        else:
+            # Shuffle records that occur at the same time level. Truncating the times to the shuffle level gives a
+            # bucket id per record. Sorting by bucket id with random tie-breaks shuffles every bucket in one call.
+            bucket_id = times // TemporalSequencer._shuffle_dict[shuffle_level]
+            order = np.lexsort((np.random.random(len(times)), -bucket_id if reverse else bucket_id))
 
+        self._timestamps = self._timestamps[order]
+        self._codes = self._codes[order]
         self._sequenced = True
+        if shuffle_level is None and not reverse and len(self._timestamps) > 0:
+            self._max_ts = self._timestamps[-1]
+        else:
+            self._max_ts = None
 
     def serialize(self, shuffle_level: str = None, reverse=False):
         """ Sequences the data and serializes to a string representation
@@ -141,15 +297,44 @@ class TemporalSequencer(MedicalCodingSequencer):
         =======
         String serialization of temporal coding sequence
         """
-        if not self._sequenced or self._shuffle_level != shuffle_level:
+        return self._serialize_header(shuffle_level, reverse) + self.sep.join(self._serialize_records())
+
+    def serialize_to(self, f, shuffle_level: str = None, reverse=False):
+        """ Sequences the data and writes the string representation to a file one record at a time, without building
+        the whole serialization in memory. Writes the same output as serialize.
+
+        Params
+        ======
+        f: file-like object opened for writing text
+        shuffle_level: str - Indicates which time unit to shuffle records on. See the
+                       documentation for the sequence method for more details.
+        reverse: bool - True to sort with most recent records first. Default: False
+        """
+        f.write(self._serialize_header(shuffle_level, reverse))
+        for i, r in enumerate(self._serialize_records()):
+            if i > 0:
+                f.write(self.sep)
+            f.write(r)
+
+    def _serialize_header(self, shuffle_level: str, reverse: bool) -> str:
+        """ Sequences the data if it is not already sequenced with these settings, and returns the metadata header
+        that starts the serialization """
+        if not self._sequenced or self._shuffle_level != shuffle_level or self._reverse != reverse:
             self.sequence(shuffle_level, reverse)
 
-        seq_str = ''
         if self.metadata is None:
             self.metadata = dict()
-        seq_str += json.dumps(self.metadata) + self.sep
-        seq_str += self.sep.join([r.serialize() for r in self.data])
-        return seq_str
+        return json.dumps(self.metadata) + self.sep
+
+    def _serialize_records(self):
+        """ Returns an iterator over the string representations of the records, in the same format as
+        TemporalRecord.serialize """
+        self._consolidate()
+        if len(self._timestamps) == 0:
+            return iter(())
+        # Format all timestamps in one pass. NumPy emits ISO format, which only differs by the date/time separator.
+        timestamp_strs = np.char.replace(np.datetime_as_string(self._timestamps, unit='us'), 'T', '_')
+        return map('({}, {})'.format, timestamp_strs, self._codes)
 
     @staticmethod
     def read(input_str: str, sep='\t'):
@@ -164,12 +349,27 @@ class TemporalSequencer(MedicalCodingSequencer):
         =======
         TemporalSequencer object
         """
-        input_list = input_str.split(sep)
-        metadata = json.loads(input_list.pop(0))
+        # Tolerate the trailing newline of a line read from a file
+        if sep != '\n' and input_str.endswith('\n'):
+            input_str = input_str[:-1]
+        metadata_str, _, records_str = input_str.partition(sep)
+        metadata = _json_loads(metadata_str)
         ts = TemporalSequencer(metadata=metadata, sep=sep)
-        for r in input_list:
-            tr = TemporalRecord.read(r)
-            ts.add_temporal_record(tr)
+
+        # Every record must match in full, otherwise the input is malformed
+        matches = [_REC_RE.fullmatch(r) for r in records_str.split(sep)] if records_str else []
+        if None in matches:
+            raise ValueError()
+
+        if matches:
+            # Parse all timestamps at once. NumPy expects ISO format, which only differs by the date/time separator.
+            timestamp_strs = [m[1] for m in matches]
+            codes = [m[2] for m in matches]
+            ts._timestamps = np.char.replace(np.array(timestamp_strs), '_', 'T').astype('datetime64[us]')
+            ts._codes = np.fromiter(codes, dtype=object, count=len(codes))
+            # Records appended later can extend the sequence only if it was serialized in ascending order
+            if np.all(ts._timestamps[1:] >= ts._timestamps[:-1]):
+                ts._max_ts = ts._timestamps[-1]
         ts._sequenced = True
         return ts
 
@@ -181,6 +381,9 @@ class TemporalSequencer(MedicalCodingSequencer):
         42          2000-01-01 00:00:00     313217, 320218
         42          2000-01-01 00:01:00     314159
 
+        Reading the excel file is usually the slowest step. The calamine engine is used if python-calamine is
+        installed (requires pandas >= 2.2). See read_dataframe to sequence data loaded some other way, e.g., from CSV.
+
         Params
         ------
         file_in: str - excel file to read
@@ -194,27 +397,59 @@ class TemporalSequencer(MedicalCodingSequencer):
         Dictionary with patient IDs as keys and TemporalSequencer objects as values
         """
         if sheet_name is not None:
-            df = pd.read_excel(file_in, sheet_name=sheet_name)
+            df = pd.read_excel(file_in, sheet_name=sheet_name, engine=_EXCEL_ENGINE)
         else:
-            df = pd.read_excel(file_in)
+            df = pd.read_excel(file_in, engine=_EXCEL_ENGINE)
+        return TemporalSequencer.read_dataframe(df, col_pid, col_time, col_codes, file_out)
+
+    @staticmethod
+    def read_dataframe(df: pd.DataFrame, col_pid, col_time, col_codes, file_out) -> Dict[Any, 'TemporalSequencer']:
+        """ Generates a dictionary of TemporalSequences from a DataFrame with the same format as read_excel expects,
+        and writes their serializations to file_out. df is not modified.
+
+        Params
+        ------
+        df: DataFrame - data to sequence
+        col_pid: str - column name with patient identifier. A categorical column is converted back to the dtype of its
+                 categories before grouping, since grouping on categoricals is slow with many patients.
+        col_time: str - column name with timestamp
+        col_codes: str - column name with codes or other data to be sequenced
+
+        Returns
+        -------
+        Dictionary with patient IDs as keys and TemporalSequencer objects as values
+        """
+        df = df[[col_pid, col_time, col_codes]].copy()
+
+        # Grouping on a categorical column is very slow with many distinct patients, so group on the underlying
+        # values instead
+        if isinstance(df[col_pid].dtype, pd.CategoricalDtype):
+            df[col_pid] = df[col_pid].astype(df[col_pid].cat.categories.dtype)
+
+        # Keep the wall-clock time of timezone-aware timestamps, as add_data does
+        if isinstance(df[col_time].dtype, pd.DatetimeTZDtype):
+            df[col_time] = df[col_time].dt.tz_localize(None)
+
+        # icd_codes column can contain multiple ICD codes separated by comma. Give each code its own row. Single numeric
+        # codes are read as numbers, so convert to str first. Missing codes and timestamps cannot be sequenced.
+        if df[col_codes].isna().any() or df[col_time].isna().any():
+            raise ValueError()
+        df[col_codes] = df[col_codes].astype(str).str.split(',')
+        df = df.explode(col_codes)
+        df[col_codes] = df[col_codes].str.strip()
 
-        pids = df[col_pid].unique().tolist()
         pt_seqs = dict()
-        for pid in pids:
-            pt_records = df[df[col_pid] == pid]
+        # Group rows by patient in a single pass. sort=False keeps patients in order of first appearance
+        for pid, pt_records in df.groupby(col_pid, sort=False):
             ts = TemporalSequencer(metadata={'pat_id': pid})
-            for index, row in pt_records.iterrows():
-                icd_codes_str = row[col_codes]
-                # icd_codes column can contain multiple ICD codes separated by comma
-                icd_codes = [x.strip() for x in icd_codes_str.split(',')]
-                for icd_code in icd_codes:
-                    ts.add_data(row[col_time], icd_code)
-
+            ts.add_bulk(pt_records[col_time].to_numpy('datetime64[us]'), pt_records[col_codes].to_numpy(object))
             ts.sequence()
             pt_seqs[pid] = ts
 
         with open(file_out, 'w') as f:
-            serialized = [x.serialize() for x in pt_seqs.values()]
-            f.writelines('\n'.join(serialized))
+            for i, ts in enumerate(pt_seqs.values()):
+                if i > 0:
+                    f.write('\n')
+                ts.serialize_to(f)
 
         return pt_seqs
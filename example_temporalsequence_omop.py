@@ -17,9 +17,11 @@ pwd=getpass.getpass()
 conn = pyodbc.connect(**sql_config, pwd=pwd)
 cursor = conn.cursor()
 
-# Get all conditions, drugs, procedures, and measurements for a person
+# Get all conditions, drugs, procedures, and measurements for a person, ordered by time so that the sequencer does not
+# need to sort them
 person_id = 123456789
 sql = """
+    SELECT concept_id, start_datetime FROM (
         (SELECT co.condition_concept_id AS concept_id, co.condition_start_datetime AS start_datetime
         FROM dbo.condition_occurrence co
         WHERE co.person_id = ?)
@@ -35,14 +37,19 @@ sql = """
         (SELECT m.measurement_concept_id AS concept_id, m.measurement_datetime AS start_datetime
         FROM dbo.measurement m
         WHERE m.person_id = ?)
+    ) AS records
+    ORDER BY start_datetime
     """
 cursor.execute(sql, person_id, person_id, person_id, person_id)
-res = cursor.fetchall()
 
-# Create TemporalSequencer and add records
+# Create TemporalSequencer and add records in batches as they are fetched, rather than holding every row in memory
 ts = TemporalSequencer(metadata={'person_id': person_id})
-for x in res:
-    ts.add_data(x[1], x[0])
+cursor.arraysize = 10000
+while True:
+    rows = cursor.fetchmany()
+    if not rows:
+        break
+    ts.add_bulk([x[1] for x in rows], [x[0] for x in rows], is_sorted=True)
 
 # Serialize in strict temporal order (no shuffling)
 print('strict order')